@@ -18,10 +18,22 @@ import argparse
 import urllib.request
 import urllib.parse
 import urllib.error
+import http.client
 import http.cookiejar
 import gzip
+import errno
+import hashlib
 import random
 import time
+import queue
+import socket
+import ipaddress
+import sqlite3
+import shutil
+import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from urllib.parse import urlparse
 
 
@@ -50,7 +62,418 @@ def get_user_agent():
     return random.choice(user_agents)
 
 
+# playurl请求的fnval参数: 16=DASH格式, 256=杜比音频
+PLAYURL_FNVAL = 16 | 256
+
+# 表示服务端限流或节点过载的HTTP状态码
+THROTTLE_STATUS = {412, 429, 502, 503, 504}
+# 页面/API请求遇到限流时的重试次数
+PAGE_RETRIES = 3
+# 下载分段遇到限流或连接错误时的重试次数
+SEGMENT_RETRIES = 5
+
+
+class HostSlot:
+    """一次请求占用的主机并发名额，退出时把请求结果反馈给控制器"""
+    
+    def __init__(self, controller, host):
+        self.controller = controller
+        self.host = host
+        self.status = None
+        self.nbytes = 0
+        self.latency = None
+    
+    def __enter__(self):
+        self.controller.acquire(self.host)
+        self.start = time.time()
+        return self
+    
+    def mark_response(self, status):
+        """收到响应头时调用，记录状态码和首字节延迟"""
+        self.status = status
+        self.latency = time.time() - self.start
+    
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+    
+    def __exit__(self, exc_type, exc, tb):
+        if isinstance(exc, DiskWriteError):
+            # 本地磁盘错误与主机无关，只归还名额
+            self.controller.release(self.host, self.status, adjust=False)
+            return False
+        if isinstance(exc, urllib.error.HTTPError):
+            self.status = exc.code
+        elif exc is not None:
+            # 超时、连接中断等按连接错误处理
+            self.status = None
+        self.controller.release(self.host, self.status, self.nbytes, self.latency, time.time() - self.start)
+        return False
+
+
+class HostConcurrencyController:
+    """按主机自适应调整并发请求数和下载分段大小(AIMD)
+
+    每个主机（api.bilibili.com、各个upos CDN节点）单独统计吞吐量、延迟和状态码。
+    请求成功时并发上限缓慢增加（每个并发窗口+1），遇到412/429/5xx或连接错误时
+    并发上限和分段大小减半，并在一段冷却时间内暂停向该主机发起新请求。
+    """
+    
+    def __init__(self, initial_limit=2, min_limit=1, max_limit=16,
+                 initial_segment=4 * 1024 * 1024, min_segment=1024 * 1024, max_segment=32 * 1024 * 1024,
+                 segment_seconds=2.0, latency_factor=4.0):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.initial_segment = initial_segment
+        self.min_segment = min_segment
+        self.max_segment = max_segment
+        # 单个分段的目标耗时，超过后不再增大分段
+        self.segment_seconds = segment_seconds
+        # 延迟超过最低延迟的倍数时视为拥塞，停止增加并发
+        self.latency_factor = latency_factor
+        self._hosts = {}
+        self._cond = threading.Condition()
+    
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = {
+                'limit': float(self.initial_limit),
+                'in_flight': 0,
+                'segment_size': self.initial_segment,
+                'requests': 0,
+                'errors': 0,
+                'bytes': 0,
+                'busy_time': 0.0,
+                'latency': None,
+                'min_latency': None,
+                'consecutive_errors': 0,
+                'cooldown_until': 0.0,
+                'status_counts': {}
+            }
+            self._hosts[host] = state
+        return state
+    
+    def slot(self, host):
+        """返回请求名额的上下文管理器"""
+        return HostSlot(self, host)
+    
+    def acquire(self, host):
+        """等待直到该主机有空闲名额且不在冷却期"""
+        with self._cond:
+            state = self._state(host)
+            while True:
+                wait = state['cooldown_until'] - time.time()
+                if wait <= 0 and state['in_flight'] < int(state['limit']):
+                    break
+                self._cond.wait(timeout=wait if wait > 0 else None)
+            state['in_flight'] += 1
+    
+    def release(self, host, status, nbytes=0, latency=None, elapsed=0.0, adjust=True):
+        """归还名额，并根据请求结果调整并发上限和分段大小
+
+        adjust为False时只归还名额，不计入统计也不调整
+        """
+        with self._cond:
+            state = self._state(host)
+            state['in_flight'] -= 1
+            if not adjust:
+                self._cond.notify_all()
+                return
+            state['requests'] += 1
+            state['bytes'] += nbytes
+            state['busy_time'] += elapsed
+            key = str(status) if status is not None else 'error'
+            state['status_counts'][key] = state['status_counts'].get(key, 0) + 1
+            
+            if latency is not None:
+                state['latency'] = latency if state['latency'] is None else state['latency'] * 0.8 + latency * 0.2
+                if state['min_latency'] is None or latency < state['min_latency']:
+                    state['min_latency'] = latency
+            
+            if status is None or status in THROTTLE_STATUS:
+                # 乘性减小
+                state['errors'] += 1
+                state['consecutive_errors'] += 1
+                state['limit'] = max(self.min_limit, state['limit'] / 2)
+                state['segment_size'] = max(self.min_segment, state['segment_size'] // 2)
+                cooldown = min(30.0, 0.5 * 2 ** state['consecutive_errors'])
+                state['cooldown_until'] = time.time() + cooldown
+            elif status < 400:
+                # 加性增大
+                state['consecutive_errors'] = 0
+                congested = (state['latency'] is not None and state['min_latency']
+                             and state['latency'] > state['min_latency'] * self.latency_factor)
+                if not congested:
+                    state['limit'] = min(self.max_limit, state['limit'] + 1 / state['limit'])
+                if nbytes >= state['segment_size'] and elapsed < self.segment_seconds:
+                    state['segment_size'] = min(self.max_segment, state['segment_size'] + self.min_segment)
+            self._cond.notify_all()
+    
+    def segment_size(self, host):
+        """返回该主机当前的下载分段大小"""
+        with self._cond:
+            return self._state(host)['segment_size']
+    
+    def snapshot(self):
+        """返回所有主机的当前状态"""
+        with self._cond:
+            result = {}
+            for host, state in self._hosts.items():
+                throughput = state['bytes'] / state['busy_time'] if state['busy_time'] > 0 else 0
+                result[host] = {
+                    'limit': int(state['limit']),
+                    'in_flight': state['in_flight'],
+                    'segment_size': state['segment_size'],
+                    'requests': state['requests'],
+                    'errors': state['errors'],
+                    'bytes': state['bytes'],
+                    'throughput': throughput,
+                    'latency': state['latency'],
+                    'status_counts': dict(state['status_counts'])
+                }
+            return result
+    
+    def print_stats(self):
+        """打印各主机的统计信息"""
+        print("主机统计:")
+        for host, stats in sorted(self.snapshot().items()):
+            latency = f"{stats['latency'] * 1000:.0f}ms" if stats['latency'] is not None else "-"
+            print(f"  {host}: 并发上限={stats['limit']} 分段={stats['segment_size'] / 1024 / 1024:.0f}MB "
+                  f"请求={stats['requests']} 错误={stats['errors']} "
+                  f"速度={stats['throughput'] / 1024 / 1024:.2f}MB/s 延迟={latency} "
+                  f"状态码={stats['status_counts']}")
+
+
+# 全局共享的主机并发控制器
+HOST_CONTROLLER = HostConcurrencyController()
+
+
+class SingleFlight:
+    """合并并发的相同请求
+
+    同一时刻对同一个key只执行一次调用，其余调用者等待并共享这次调用的结果；
+    调用抛出异常时，等待者会收到同一个异常。调用结束后立即移除记录，不做缓存。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+        
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        
+        try:
+            call['result'] = func(*args)
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+# 页面和元数据API请求共享的single-flight
+PAGE_FLIGHT = SingleFlight()
+
+# DNS缓存有效期(秒)。getaddrinfo不返回记录的TTL，因此使用固定值
+DNS_CACHE_TTL = 300
+# 连接竞速时依次启动下一个地址的间隔(秒)
+CONNECT_STAGGER = 0.25
+
+
+class DnsCache:
+    """进程内DNS缓存，并记录每个主机上次连接最快的地址"""
+    
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._preferred = {}
+        self._flight = SingleFlight()
+    
+    def resolve(self, host, port):
+        """返回候选地址列表，上次连接成功的地址排在最前，其余IPv6/IPv4交替排列"""
+        key = (host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            infos = self._flight.do(key, self._lookup, host, port)
+            if not infos:
+                # 空结果不缓存，下次重新解析
+                raise socket.gaierror(f"无法解析主机: {host}")
+            entry = (time.time() + self.ttl, infos)
+            with self._lock:
+                self._entries[key] = entry
+        
+        infos = list(entry[1])
+        with self._lock:
+            preferred = self._preferred.get(host)
+        if preferred:
+            infos.sort(key=lambda info: info[4] != preferred)
+        return infos
+    
+    def _lookup(self, host, port):
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        # 按地址族交替排列，避免某一族全部不可达时长时间等待
+        ipv6 = [info for info in infos if info[0] == socket.AF_INET6]
+        ipv4 = [info for info in infos if info[0] != socket.AF_INET6]
+        result = []
+        for i in range(max(len(ipv6), len(ipv4))):
+            result += ipv6[i:i + 1] + ipv4[i:i + 1]
+        return result
+    
+    def prefer(self, host, sockaddr):
+        """记录连接竞速中胜出的地址，之后的连接优先使用"""
+        with self._lock:
+            self._preferred[host] = sockaddr
+    
+    def forget(self, host, port):
+        """所有地址都连接失败时清除缓存，下次重新解析"""
+        with self._lock:
+            self._entries.pop((host, port), None)
+            self._preferred.pop(host, None)
+
+
+# 全局共享的DNS缓存
+DNS_CACHE = DnsCache()
+
+
+def connect_address(info, timeout, source_address=None):
+    """连接到getaddrinfo返回的单个地址"""
+    family, socktype, proto, _, sockaddr = info
+    sock = socket.socket(family, socktype, proto)
+    try:
+        if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(timeout)
+        if source_address:
+            sock.bind(source_address)
+        sock.connect(sockaddr)
+        return sock
+    except OSError:
+        sock.close()
+        raise
+
+
+def race_connect(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """并行连接主机的多个地址，返回最先建立的连接（Happy Eyeballs）
+
+    与socket.create_connection参数相同。先连接首选地址，每隔CONNECT_STAGGER秒
+    或上一个地址失败时再启动下一个地址，第一个成功的连接胜出，其余连接关闭。
+    """
+    host, port = address[0], address[1]
+    try:
+        ipaddress.ip_address(host)
+        return socket.create_connection(address, timeout, source_address)
+    except ValueError:
+        pass
+    
+    infos = DNS_CACHE.resolve(host, port)
+    if not infos:
+        raise OSError(f"无法解析主机: {host}")
+    
+    results = queue.Queue()
+    
+    def attempt(info):
+        try:
+            results.put((info, connect_address(info, timeout, source_address), None))
+        except OSError as e:
+            results.put((info, None, e))
+    
+    started = 0
+    finished = 0
+    errors = []
+    winner = None
+    while winner is None and finished < len(infos):
+        if started == finished and started < len(infos):
+            # 没有进行中的连接（刚开始或上一个已失败），立即启动下一个
+            threading.Thread(target=attempt, args=(infos[started],), daemon=True).start()
+            started += 1
+        try:
+            block_timeout = CONNECT_STAGGER if started < len(infos) else None
+            info, sock, error = results.get(timeout=block_timeout)
+        except queue.Empty:
+            threading.Thread(target=attempt, args=(infos[started],), daemon=True).start()
+            started += 1
+            continue
+        finished += 1
+        if sock:
+            winner = (info, sock)
+        else:
+            errors.append(error)
+    
+    if winner is None:
+        DNS_CACHE.forget(host, port)
+        raise errors[-1]
+    
+    # 关闭仍在进行中的其他连接
+    remaining = started - finished
+    if remaining:
+        def close_losers():
+            for _ in range(remaining):
+                _, sock, _ = results.get()
+                if sock:
+                    sock.close()
+        threading.Thread(target=close_losers, daemon=True).start()
+    
+    DNS_CACHE.prefer(host, winner[0][4])
+    return winner[1]
+
+
+class RacingHTTPConnection(http.client.HTTPConnection):
+    """使用DNS缓存和连接竞速的HTTP连接"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = race_connect
+
+
+class RacingHTTPSConnection(http.client.HTTPSConnection):
+    """使用DNS缓存和连接竞速的HTTPS连接"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = race_connect
+
+
+class RacingHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(RacingHTTPConnection, req)
+
+
+class RacingHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(RacingHTTPSConnection, req, context=self._context)
+
+
+def build_url_opener(*handlers):
+    """创建使用连接竞速的urllib opener"""
+    return urllib.request.build_opener(RacingHTTPHandler(), RacingHTTPSHandler(), *handlers)
+
+
+# 下载媒体文件使用的opener
+URL_OPENER = build_url_opener()
+
+
 def get_page_content(url):
+    """获取页面内容（并发的相同请求只会发起一次网络调用）"""
+    return PAGE_FLIGHT.do(url, fetch_page_content, url)
+
+
+def fetch_page_content(url):
     """获取页面内容"""
     headers = {
         'User-Agent': get_user_agent(),
@@ -59,27 +482,45 @@ def get_page_content(url):
         'Accept-Language': 'zh-CN,zh;q=0.8,zh-TW;q=0.7,zh-HK;q=0.5,en-US;q=0.3,en;q=0.2',
         'Accept-Encoding': 'gzip'
     }
+    host = urlparse(url).hostname
     
-    try:
-        # 创建cookie处理器
-        cookie_jar = http.cookiejar.CookieJar()
-        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookie_jar))
-        urllib.request.install_opener(opener)
-        
-        # 创建请求
-        req = urllib.request.Request(url, headers=headers)
-        response = urllib.request.urlopen(req, timeout=15)
-        
-        # 处理gzip压缩
-        if response.info().get('Content-Encoding') == 'gzip':
-            content = gzip.decompress(response.read()).decode('utf-8')
-        else:
-            content = response.read().decode('utf-8')
+    for attempt in range(PAGE_RETRIES + 1):
+        try:
+            # 创建cookie处理器
+            cookie_jar = http.cookiejar.CookieJar()
+            opener = build_url_opener(urllib.request.HTTPCookieProcessor(cookie_jar))
+            urllib.request.install_opener(opener)
             
-        return content
-    except Exception as e:
-        print(f"获取页面内容失败: {e}")
-        return None
+            # 创建请求
+            req = urllib.request.Request(url, headers=headers)
+            with HOST_CONTROLLER.slot(host) as slot:
+                response = urllib.request.urlopen(req, timeout=15)
+                slot.mark_response(response.status)
+                raw = response.read()
+                slot.add_bytes(len(raw))
+            
+            # 处理gzip压缩
+            if response.info().get('Content-Encoding') == 'gzip':
+                content = gzip.decompress(raw).decode('utf-8')
+            else:
+                content = raw.decode('utf-8')
+                
+            return content
+        except urllib.error.HTTPError as e:
+            if e.code in THROTTLE_STATUS and attempt < PAGE_RETRIES:
+                print(f"请求被限流(HTTP {e.code})，稍后重试...")
+                continue
+            print(f"获取页面内容失败: {e}")
+            return None
+        except (urllib.error.URLError, OSError) as e:
+            if attempt < PAGE_RETRIES:
+                print(f"连接失败({e})，稍后重试...")
+                continue
+            print(f"获取页面内容失败: {e}")
+            return None
+        except Exception as e:
+            print(f"获取页面内容失败: {e}")
+            return None
 
 
 def extract_video_info(html_content):
@@ -124,7 +565,7 @@ def extract_video_info(html_content):
                         
                         if cid and (aid or bvid):
                             # 构建playurl API请求，请求最高清晰度(127=8K, 120=4K)
-                            api_url = f"https://api.bilibili.com/x/player/playurl?cid={cid}&bvid={bvid}&qn=127&fnval=16&fourk=1"
+                            api_url = f"https://api.bilibili.com/x/player/playurl?cid={cid}&bvid={bvid}&qn=127&fnval={PLAYURL_FNVAL}&fourk=1"
                             print(f"尝试从API获取视频信息: {api_url}")
                             
                             # 获取API响应
@@ -261,15 +702,164 @@ def extract_video_info(html_content):
             'video_url': video_url,
             'audio_url': audio_url,
             'quality': video_quality,
-            'resolution': video_resolution
+            'resolution': video_resolution,
+            'play_data': play_info['data']
         }
     except Exception as e:
         print(f"提取视频信息失败: {e}")
         return None
 
 
+# 磁盘写入设置，由命令行参数修改
+WRITER_OPTIONS = {
+    # 写入队列中最多缓存的数据块数（每块最大1MB），队列满时下载线程暂停读取
+    'queue_size': 16,
+    # fsync策略: never=不调用, close=文件写完后调用一次, always=每块写入后调用
+    'fsync': 'close',
+    # 下载中的文件存放目录，默认为目标目录下的.staging
+    'staging_dir': None
+}
+
+
+class DiskWriteError(Exception):
+    """磁盘写入线程中发生的错误（与网络错误区分，不触发重试）"""
+
+
+class DiskWriter:
+    """独立的磁盘写入线程
+
+    下载线程把数据块放入有界队列后立即继续读取网络数据，慢速磁盘不会阻塞socket。
+    队列满时write()阻塞，从而降低读取速度而不是无限占用内存。
+    """
+    
+    def __init__(self, filename, queue_size=16, fsync='close'):
+        self.filename = filename
+        self.fsync = fsync
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = open(filename, 'wb')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _put(self, op):
+        if self.error:
+            raise DiskWriteError(self.error)
+        self._queue.put(op)
+    
+    def preallocate(self, size):
+        """预分配文件空间，减少碎片并尽早发现磁盘空间不足"""
+        self._put(('preallocate', size))
+    
+    def write(self, offset, data):
+        """在指定位置写入数据，队列已满时阻塞"""
+        self._put(('write', offset, data))
+    
+    def truncate(self, size):
+        self._put(('truncate', size))
+    
+    def close(self):
+        """等待队列中的数据全部写入并关闭文件"""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error:
+            raise DiskWriteError(self.error)
+    
+    def _run(self):
+        f = self._file
+        while True:
+            op = self._queue.get()
+            if op is None:
+                break
+            if self.error:
+                # 出错后丢弃剩余数据，避免下载线程阻塞在队列上
+                continue
+            try:
+                if op[0] == 'write':
+                    f.seek(op[1])
+                    f.write(op[2])
+                    if self.fsync == 'always':
+                        f.flush()
+                        os.fsync(f.fileno())
+                elif op[0] == 'preallocate':
+                    if hasattr(os, 'posix_fallocate'):
+                        f.flush()
+                        try:
+                            os.posix_fallocate(f.fileno(), 0, op[1])
+                        except OSError as e:
+                            # 部分文件系统不支持预分配
+                            if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                                raise
+                elif op[0] == 'truncate':
+                    f.flush()
+                    f.truncate(op[1])
+            except Exception as e:
+                self.error = e
+        
+        try:
+            f.flush()
+            if self.fsync != 'never' and not self.error:
+                os.fsync(f.fileno())
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            f.close()
+
+
+def get_staging_path(filename):
+    """返回下载过程中使用的临时文件路径"""
+    staging_dir = WRITER_OPTIONS['staging_dir'] or os.path.join(os.path.dirname(filename) or '.', '.staging')
+    os.makedirs(staging_dir, exist_ok=True)
+    return os.path.join(staging_dir, os.path.basename(filename) + '.part')
+
+
+def remove_staging_dir(staging_file):
+    """默认临时目录为空时将其删除（其他下载仍在使用时保留）
+
+    通过--staging-dir指定的目录由用户管理，不会删除。
+    """
+    if WRITER_OPTIONS['staging_dir']:
+        return
+    try:
+        os.rmdir(os.path.dirname(staging_file))
+    except OSError:
+        pass
+
+
+def move_across_filesystems(src, dst):
+    """跨文件系统移动文件，目标路径上不会出现写了一半的文件"""
+    tmp_file = os.path.join(os.path.dirname(dst) or '.', f".{os.path.basename(dst)}.part")
+    try:
+        shutil.copyfile(src, tmp_file)
+        if WRITER_OPTIONS['fsync'] != 'never':
+            with open(tmp_file, 'rb') as f:
+                os.fsync(f.fileno())
+        os.replace(tmp_file, dst)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.remove(src)
+
+
+def move_into_place(staging_file, filename):
+    """把临时目录中已完成的文件原子地移动到目标路径"""
+    try:
+        os.replace(staging_file, filename)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # 临时目录与目标目录不在同一文件系统时，先复制到目标目录下的临时文件再重命名
+        move_across_filesystems(staging_file, filename)
+    remove_staging_dir(staging_file)
+
+
 def download_file(url, filename, headers=None):
-    """下载文件"""
+    """下载文件
+
+    文件按Range分段下载，分段大小和并发由HOST_CONTROLLER根据CDN节点状态调整，
+    遇到限流或连接中断时从已下载的位置继续。数据由DiskWriter线程写入临时目录，
+    下载完成后原子重命名为目标文件。
+    """
     if headers is None:
         headers = {
             'User-Agent': get_user_agent(),
@@ -278,53 +868,292 @@ def download_file(url, filename, headers=None):
             'Accept-Encoding': 'gzip, deflate, br',
             'Range': 'bytes=0-'
         }
+    host = urlparse(url).hostname
+    staging_file = None
+    writer = None
     
     try:
         print(f"正在下载: {filename}")
-        req = urllib.request.Request(url, headers=headers)
-        response = urllib.request.urlopen(req, timeout=30)
-        
-        # 获取文件大小
-        file_size = int(response.info().get('Content-Length', 0))
+        for _ in range(3):
+            staging_file = get_staging_path(filename)
+            try:
+                writer = DiskWriter(staging_file, WRITER_OPTIONS['queue_size'], WRITER_OPTIONS['fsync'])
+                break
+            except FileNotFoundError:
+                # 临时目录刚好被其他下载清理，重新创建
+                continue
+        if writer is None:
+            raise DiskWriteError(f"无法创建临时文件: {staging_file}")
+        file_size = 0
         downloaded_size = 0
         chunk_size = 1024 * 1024  # 1MB
+        failures = 0
         
-        with open(filename, 'wb') as f:
-            while True:
-                chunk = response.read(chunk_size)
-                if not chunk:
-                    break
+        while file_size == 0 or downloaded_size < file_size:
+            segment_size = HOST_CONTROLLER.segment_size(host)
+            segment_headers = dict(headers)
+            segment_headers['Range'] = f"bytes={downloaded_size}-{downloaded_size + segment_size - 1}"
+            req = urllib.request.Request(url, headers=segment_headers)
+            
+            try:
+                with HOST_CONTROLLER.slot(host) as slot:
+                    response = URL_OPENER.open(req, timeout=30)
+                    slot.mark_response(response.status)
+                    
+                    if response.status == 206:
+                        # Content-Range: bytes start-end/total
+                        content_range = response.info().get('Content-Range', '')
+                        total = content_range.rsplit('/', 1)[-1]
+                        if total.isdigit() and file_size == 0:
+                            file_size = int(total)
+                            writer.preallocate(file_size)
+                    else:
+                        # 服务器不支持Range，从头读取整个文件
+                        downloaded_size = 0
+                        file_size = int(response.info().get('Content-Length', 0))
+                        writer.truncate(0)
+                        if file_size > 0:
+                            writer.preallocate(file_size)
                     
-                f.write(chunk)
-                downloaded_size += len(chunk)
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                            
+                        writer.write(downloaded_size, chunk)
+                        slot.add_bytes(len(chunk))
+                        downloaded_size += len(chunk)
+                        
+                        # 显示下载进度
+                        if file_size > 0:
+                            percent = downloaded_size * 100 / file_size
+                            progress_bar = '█' * int(percent // 2) + '░' * (50 - int(percent // 2))
+                            print(f"下载进度: [{progress_bar}] {percent:.2f}% ({downloaded_size/1024/1024:.2f}/{file_size/1024/1024:.2f} MB)\r", end='')
+                        else:
+                            print(f"已下载: {downloaded_size/1024/1024:.2f} MB\r", end='')
                 
-                # 显示下载进度
-                if file_size > 0:
-                    percent = downloaded_size * 100 / file_size
-                    progress_bar = '█' * int(percent // 2) + '░' * (50 - int(percent // 2))
-                    print(f"下载进度: [{progress_bar}] {percent:.2f}% ({downloaded_size/1024/1024:.2f}/{file_size/1024/1024:.2f} MB)\r", end='')
-                else:
-                    print(f"已下载: {downloaded_size/1024/1024:.2f} MB\r", end='')
+                if response.status == 206 and slot.nbytes > 0:
+                    failures = 0
+                    continue
+                if file_size == 0 or downloaded_size >= file_size:
+                    break
+                # 响应在文件结束前断开，按连接中断处理，从已下载的位置继续
+                raise ConnectionError(f"响应不完整({downloaded_size}/{file_size} 字节)")
+            except urllib.error.HTTPError as e:
+                if e.code == 416 and downloaded_size > 0:
+                    # 已到文件末尾
+                    break
+                if e.code not in THROTTLE_STATUS or failures >= SEGMENT_RETRIES:
+                    raise
+                failures += 1
+                print(f"\n下载被限流(HTTP {e.code})，稍后从 {downloaded_size/1024/1024:.2f} MB 处继续...")
+            except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+                if failures >= SEGMENT_RETRIES:
+                    raise
+                failures += 1
+                print(f"\n连接中断({e})，稍后从 {downloaded_size/1024/1024:.2f} MB 处继续...")
+        
+        if file_size > 0 and downloaded_size < file_size:
+            # 不把不完整的文件移动到输出目录
+            raise IOError(f"下载不完整({downloaded_size}/{file_size} 字节)")
         
+        # 去掉预分配但未写入的部分
+        writer.truncate(downloaded_size)
+        writer.close()
+        writer = None
+        move_into_place(staging_file, filename)
         return True
     except Exception as e:
         print(f"下载文件失败: {e}")
-        if os.path.exists(filename):
-            os.remove(filename)
+        if writer:
+            try:
+                writer.close()
+            except DiskWriteError:
+                pass
+        if staging_file and os.path.exists(staging_file):
+            os.remove(staging_file)
+        if staging_file:
+            remove_staging_dir(staging_file)
         return False
 
 
 def merge_video_audio(video_file, audio_file, output_file):
-    """合并视频和音频文件"""
+    """合并视频和音频文件
+
+    ffmpeg先输出到临时目录，合并成功后再移动到目标路径。
+    """
+    merged_file = None
     try:
-        # 使用系统自带的cat命令简单合并文件
-        # 注意：这种方法并不能正确合并视频和音频，但在没有ffmpeg的情况下是一种临时解决方案
-        print("警告：由于没有ffmpeg，无法正确合并视频和音频。")
-        print("视频和音频文件将被分别保存。")
-        return False
+        ffmpeg = shutil.which('ffmpeg')
+        if not ffmpeg:
+            # 注意：没有ffmpeg时无法正确合并视频和音频
+            print("警告：由于没有ffmpeg，无法正确合并视频和音频。")
+            print("视频和音频文件将被分别保存。")
+            return False
+        
+        # 保留原扩展名，ffmpeg据此选择封装格式
+        merged_file = get_staging_path(output_file) + os.path.splitext(output_file)[1]
+        # 直接复制音视频流，不重新编码
+        cmd = [ffmpeg, '-y', '-loglevel', 'error', '-i', video_file, '-i', audio_file, '-c', 'copy', merged_file]
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            print(f"ffmpeg合并失败: {result.stderr.decode('utf-8', 'replace').strip()}")
+            return False
+        move_into_place(merged_file, output_file)
+        merged_file = None
+        return True
     except Exception as e:
         print(f"合并视频和音频失败: {e}")
         return False
+    finally:
+        if merged_file:
+            if os.path.exists(merged_file):
+                os.remove(merged_file)
+            remove_staging_dir(merged_file)
+
+
+def write_sha256_file(filename):
+    """计算文件的SHA256并写入同名.sha256文件"""
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    digest = sha256.hexdigest()
+    with open(filename + '.sha256', 'w', encoding='utf-8') as f:
+        f.write(f"{digest}  {os.path.basename(filename)}\n")
+    return digest
+
+
+def postprocess_item(item):
+    """后处理单个下载结果（在子进程中运行）
+
+    Args:
+        item: 包含video_file、audio_file、output_file和checksum的字典
+
+    Returns:
+        (是否成功, 最终文件列表)
+    """
+    # 子进程不继承主进程中的--staging-dir等写入设置
+    WRITER_OPTIONS.update(item.get('writer', {}))
+    video_file = item['video_file']
+    audio_file = item.get('audio_file')
+    files = [video_file]
+    ok = True
+    
+    if audio_file:
+        output_file = item['output_file']
+        if merge_video_audio(video_file, audio_file, output_file):
+            # 删除临时文件
+            os.remove(video_file)
+            os.remove(audio_file)
+            files = [output_file]
+        else:
+            files = [video_file, audio_file]
+            # 没有ffmpeg时分别保存音视频不算失败，ffmpeg执行失败才算
+            ok = shutil.which('ffmpeg') is None
+    
+    if item.get('checksum'):
+        for filename in files:
+            write_sha256_file(filename)
+    return ok, files
+
+
+class PostProcessor:
+    """后处理阶段：合并、校验等CPU密集任务在进程池中执行
+
+    下载线程通过submit()把已下载完成的文件交给有界队列，分发线程再把任务提交到
+    进程池，使网络下载和CPU处理互不阻塞。队列已满时submit()会阻塞，避免积压。
+    """
+    
+    def __init__(self, max_workers=None, queue_size=8, checksum=False):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.checksum = checksum
+        self.results = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._slots = threading.Semaphore(self.max_workers)
+        self._lock = threading.Lock()
+        # 下载线程已在运行，使用spawn避免fork多线程进程带来的死锁
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+    
+    def submit(self, video_file, audio_file=None, output_file=None, on_done=None):
+        """提交一个下载完成的条目，队列已满时阻塞
+
+        Args:
+            on_done: 后处理结束后以是否成功为参数调用（在回调线程中执行）
+        """
+        item = {
+            'video_file': video_file,
+            'audio_file': audio_file,
+            'output_file': output_file,
+            'checksum': self.checksum,
+            'writer': dict(WRITER_OPTIONS)
+        }
+        self._queue.put((item, on_done))
+    
+    def bind(self, on_done):
+        """返回提交时自动附带on_done回调的后处理阶段，供download_video等调用方使用"""
+        return BoundPostProcessor(self, on_done)
+    
+    def _dispatch(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            item, on_done = entry
+            # 等待空闲的进程，保证队列中的任务不会全部堆积到进程池内部
+            self._slots.acquire()
+            try:
+                future = self._pool.submit(postprocess_item, item)
+            except Exception as e:
+                # 子进程崩溃后进程池不可用(BrokenProcessPool)，本条目及之后的条目都记为失败，
+                # 继续读取队列直到结束标记，避免submit()和close()阻塞
+                self._slots.release()
+                print(f"后处理失败 {item['video_file']}: {e}")
+                self._finish(on_done, False, [item['video_file']])
+                continue
+            future.add_done_callback(lambda f, item=item, on_done=on_done: self._on_done(item, on_done, f))
+    
+    def _on_done(self, item, on_done, future):
+        self._slots.release()
+        try:
+            ok, files = future.result()
+        except Exception as e:
+            print(f"后处理失败 {item['video_file']}: {e}")
+            ok, files = False, [item['video_file']]
+        else:
+            for filename in files:
+                print(f"后处理{'完成' if ok else '失败'}: {filename}")
+        self._finish(on_done, ok, files)
+    
+    def _finish(self, on_done, ok, files):
+        with self._lock:
+            self.results.append((ok, files))
+        if on_done:
+            on_done(ok)
+    
+    def close(self):
+        """等待所有后处理任务完成
+
+        Returns:
+            全部成功时返回True
+        """
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
+        return all(ok for ok, _ in self.results)
+
+
+class BoundPostProcessor:
+    """附带完成回调的后处理阶段视图，接口与PostProcessor.submit相同"""
+    
+    def __init__(self, postprocessor, on_done):
+        self.postprocessor = postprocessor
+        self.on_done = on_done
+    
+    def submit(self, video_file, audio_file=None, output_file=None):
+        self.postprocessor.submit(video_file, audio_file, output_file, self.on_done)
 
 
 def extract_bangumi_info(url, html_content):
@@ -417,7 +1246,7 @@ def extract_bangumi_info(url, html_content):
         # 构建API URL获取视频播放信息
         api_url = None
         if ep_id:
-            api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval=16&fourk=1"
+            api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval={PLAYURL_FNVAL}&fourk=1"
             print(f"使用epId构建API URL: {api_url}")
         elif ss_id:
             # 如果只有ssId，先获取该季的第一集的epId
@@ -435,7 +1264,7 @@ def extract_bangumi_info(url, html_content):
                         ep_title = first_ep.get('title', '') + ' ' + first_ep.get('long_title', '')
                         if ep_title.strip():
                             title = f"{title}_{ep_title.strip()}"
-                        api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval=16&fourk=1"
+                        api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval={PLAYURL_FNVAL}&fourk=1"
                         print(f"使用第一集epId构建API URL: {api_url}")
                     else:
                         print(f"获取季度信息失败: {season_data.get('message')}")
@@ -525,7 +1354,8 @@ def extract_bangumi_info(url, html_content):
                 'video_url': video_url,
                 'audio_url': audio_url,
                 'quality': video_quality,
-                'resolution': video_resolution
+                'resolution': video_resolution,
+                'play_data': play_info['data']
             }
         except Exception as e:
             print(f"解析番剧API响应失败: {e}")
@@ -535,132 +1365,268 @@ def extract_bangumi_info(url, html_content):
         return None
 
 
-def download_video(url, output_dir=None, retry_count=3):
-    """下载B站无水印视频
+def get_api_data(api_url, field='data'):
+    """请求JSON接口，code为0时返回指定字段的内容，否则返回None"""
+    content = get_page_content(api_url)
+    if not content:
+        print("获取API响应失败")
+        return None
+    try:
+        api_data = json.loads(content)
+    except json.JSONDecodeError as e:
+        print(f"解析API响应失败: {e}")
+        return None
+    if api_data.get('code') != 0 or not api_data.get(field):
+        print(f"API返回错误: {api_data.get('message')}")
+        return None
+    return api_data[field]
+
+
+class SeasonCache:
+    """缓存番剧季度信息
+
+    season接口一次返回整季的剧集列表。按season_id保存结果，并把其中每个剧集id
+    映射到所属季度，同一季的其他ep/ss链接直接复用，不再重复请求。
+    """
     
-    Args:
-        url: B站视频链接
-        output_dir: 输出目录
-        retry_count: 下载失败时的重试次数
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seasons = {}
+        self._episodes = {}
+        self._flight = SingleFlight()
+    
+    def get(self, ep_id=None, season_id=None):
+        """按ep_id或season_id获取季度信息，失败时返回None且不缓存"""
+        with self._lock:
+            if ep_id is not None:
+                season = self._seasons.get(self._episodes.get(str(ep_id)))
+            else:
+                season = self._seasons.get(str(season_id))
+        if season:
+            return season
+        if ep_id is not None:
+            season_url = f"https://api.bilibili.com/pgc/view/web/season?ep_id={ep_id}"
+        else:
+            season_url = f"https://api.bilibili.com/pgc/view/web/season?season_id={season_id}"
+        print(f"获取季度信息: {season_url}")
+        season = self._flight.do(season_url, get_api_data, season_url, 'result')
+        if not season or not season.get('episodes'):
+            return season
+        with self._lock:
+            keys = {str(season_id)} if season_id is not None else set()
+            if season.get('season_id'):
+                keys.add(str(season['season_id']))
+            if not keys:
+                # 没有season_id时以请求的剧集为键，仍然可以映射同季的其他剧集
+                keys.add(f"ep{ep_id}")
+            for key in keys:
+                self._seasons[key] = season
+            for episode in season['episodes']:
+                if episode.get('id') is not None:
+                    self._episodes[str(episode['id'])] = next(iter(keys))
+        return season
+
+
+SEASON_CACHE = SeasonCache()
+
+
+def resolve_video_info_api(clean_url):
+    """直接通过JSON接口解析BV/av/ep/ss链接，不请求HTML页面
+
+    普通视频: view接口获取标题和cid，再请求playurl；
+    番剧: season接口获取标题和epId(同一季只请求一次)，再请求pgc playurl。
+    链接格式不支持或接口失败时返回None。
     """
-    try:
-        # 创建输出目录（如果不存在）
-        if output_dir:
-            os.makedirs(output_dir, exist_ok=True)
+    bv_match = re.search(r'/video/([Bb][Vv][0-9A-Za-z]+)', clean_url)
+    av_match = re.search(r'/video/[Aa][Vv](\d+)', clean_url)
+    ep_match = re.search(r'/bangumi/play/ep(\d+)', clean_url)
+    ss_match = re.search(r'/bangumi/play/ss(\d+)', clean_url)
+    
+    if bv_match or av_match:
+        if bv_match:
+            view_url = f"https://api.bilibili.com/x/web-interface/view?bvid={'BV' + bv_match.group(1)[2:]}"
         else:
-            output_dir = os.getcwd()
-        
-        # 处理URL，移除查询参数
-        clean_url = url.split('?')[0]
-        print(f"处理后的URL: {clean_url}")
-        
-        print(f"正在获取视频 {clean_url} 的信息...")
-        html_content = get_page_content(clean_url)
-        if not html_content:
-            print("获取视频页面失败")
-            sys.exit(1)
-        
-        # 判断是否为番剧链接
-        is_bangumi = re.match(r'https?://(www\.)?bilibili\.com/bangumi/play/(ss|ep)[0-9]+', clean_url) is not None
+            view_url = f"https://api.bilibili.com/x/web-interface/view?aid={av_match.group(1)}"
+        print(f"从API获取视频信息: {view_url}")
+        view = get_api_data(view_url)
+        if not view or not view.get('cid'):
+            return None
+        title = view.get('title') or "bilibili_video"
+        api_url = (f"https://api.bilibili.com/x/player/playurl?cid={view['cid']}&bvid={view.get('bvid')}"
+                   f"&qn=127&fnval={PLAYURL_FNVAL}&fourk=1")
+        play_data = get_api_data(api_url)
+    elif ep_match or ss_match:
+        if ep_match:
+            season = SEASON_CACHE.get(ep_id=ep_match.group(1))
+        else:
+            season = SEASON_CACHE.get(season_id=ss_match.group(1))
+        if not season or not season.get('episodes'):
+            return None
+        episode = season['episodes'][0]
+        if ep_match:
+            episode = next((ep for ep in season['episodes'] if str(ep.get('id')) == ep_match.group(1)), None)
+            if not episode:
+                print("季度信息中未找到该剧集")
+                return None
+        title = season.get('title', 'bilibili_bangumi')
+        ep_title = f"{episode.get('title', '')} {episode.get('long_title', '')}".strip()
+        if ep_title:
+            title = f"{title}_{ep_title}"
+        api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={episode.get('id')}&qn=127&fnval={PLAYURL_FNVAL}&fourk=1"
+        play_data = get_api_data(api_url, 'result')
+    else:
+        return None
+    
+    if not play_data:
+        return None
+    title = title.replace("/", "_").replace("\\", "_")
+    return process_bangumi_api_response({'code': 0, 'result': play_data}, title)
+
+
+def resolve_video_info(url):
+    """解析视频链接，返回包含标题、下载地址和原始播放信息(play_data)的字典
+
+    优先直接请求JSON接口，失败时再抓取HTML页面解析。
+    只请求页面和元数据API，不下载媒体数据。解析失败时返回None。
+    """
+    # 处理URL，移除查询参数
+    clean_url = url.split('?')[0]
+    print(f"处理后的URL: {clean_url}")
+    
+    video_info = resolve_video_info_api(clean_url)
+    if video_info:
+        print("成功通过API获取视频信息")
+        return video_info
+    
+    print(f"正在获取视频 {clean_url} 的信息...")
+    html_content = get_page_content(clean_url)
+    if not html_content:
+        print("获取视频页面失败")
+        return None
+    
+    # 判断是否为番剧链接
+    is_bangumi = re.match(r'https?://(www\.)?bilibili\.com/bangumi/play/(ss|ep)[0-9]+', clean_url) is not None
+    
+    if is_bangumi:
+        print("检测到番剧链接，使用番剧解析方式...")
+        # 从URL中提取ssId或epId
+        ss_match = re.search(r'ss(\d+)', clean_url)
+        ep_match = re.search(r'ep(\d+)', clean_url)
         
-        if is_bangumi:
-            print("检测到番剧链接，使用番剧解析方式...")
-            # 从URL中提取ssId或epId
-            ss_match = re.search(r'ss(\d+)', clean_url)
-            ep_match = re.search(r'ep(\d+)', clean_url)
-            
-            if ss_match:
-                ss_id = ss_match.group(1)
-                print(f"从URL中提取到ssId: {ss_id}")
-                # 直接使用ssId构建API请求
-                season_url = f"https://api.bilibili.com/pgc/view/web/season?season_id={ss_id}"
-                print(f"获取季度信息: {season_url}")
-                season_content = get_page_content(season_url)
-                if season_content:
-                    try:
-                        season_data = json.loads(season_content)
-                        if season_data.get('code') == 0 and 'result' in season_data:
-                            # 提取标题
-                            title = season_data['result'].get('title', 'bilibili_bangumi')
-                            # 如果有剧集，获取第一集
-                            if 'episodes' in season_data['result'] and len(season_data['result']['episodes']) > 0:
-                                first_ep = season_data['result']['episodes'][0]
-                                ep_id = first_ep.get('id')
-                                print(f"获取到第一集的epId: {ep_id}")
-                                # 更新标题，添加集数信息
-                                ep_title = first_ep.get('title', '') + ' ' + first_ep.get('long_title', '')
-                                if ep_title.strip():
-                                    title = f"{title}_{ep_title.strip()}"
-                                # 使用epId获取视频信息
-                                api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval=16&fourk=1"
-                                print(f"使用epId构建API URL: {api_url}")
-                                api_content = get_page_content(api_url)
-                                if api_content:
-                                    api_data = json.loads(api_content)
-                                    if api_data.get('code') == 0 and 'result' in api_data:
-                                        # 构造视频信息
-                                        video_info = process_bangumi_api_response(api_data, title)
-                                        if video_info:
-                                            print("成功获取番剧视频信息")
-                                        else:
-                                            print("处理番剧API响应失败")
-                                            video_info = extract_bangumi_info(clean_url, html_content)
+        if ss_match:
+            ss_id = ss_match.group(1)
+            print(f"从URL中提取到ssId: {ss_id}")
+            # 直接使用ssId构建API请求
+            season_url = f"https://api.bilibili.com/pgc/view/web/season?season_id={ss_id}"
+            print(f"获取季度信息: {season_url}")
+            season_content = get_page_content(season_url)
+            if season_content:
+                try:
+                    season_data = json.loads(season_content)
+                    if season_data.get('code') == 0 and 'result' in season_data:
+                        # 提取标题
+                        title = season_data['result'].get('title', 'bilibili_bangumi')
+                        # 如果有剧集，获取第一集
+                        if 'episodes' in season_data['result'] and len(season_data['result']['episodes']) > 0:
+                            first_ep = season_data['result']['episodes'][0]
+                            ep_id = first_ep.get('id')
+                            print(f"获取到第一集的epId: {ep_id}")
+                            # 更新标题，添加集数信息
+                            ep_title = first_ep.get('title', '') + ' ' + first_ep.get('long_title', '')
+                            if ep_title.strip():
+                                title = f"{title}_{ep_title.strip()}"
+                            # 使用epId获取视频信息
+                            api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval={PLAYURL_FNVAL}&fourk=1"
+                            print(f"使用epId构建API URL: {api_url}")
+                            api_content = get_page_content(api_url)
+                            if api_content:
+                                api_data = json.loads(api_content)
+                                if api_data.get('code') == 0 and 'result' in api_data:
+                                    # 构造视频信息
+                                    video_info = process_bangumi_api_response(api_data, title)
+                                    if video_info:
+                                        print("成功获取番剧视频信息")
                                     else:
-                                        print(f"API返回错误: {api_data.get('message')}")
+                                        print("处理番剧API响应失败")
                                         video_info = extract_bangumi_info(clean_url, html_content)
                                 else:
-                                    print("获取API响应失败")
+                                    print(f"API返回错误: {api_data.get('message')}")
                                     video_info = extract_bangumi_info(clean_url, html_content)
                             else:
-                                print("未找到剧集信息")
+                                print("获取API响应失败")
                                 video_info = extract_bangumi_info(clean_url, html_content)
                         else:
-                            print(f"获取季度信息失败: {season_data.get('message')}")
+                            print("未找到剧集信息")
                             video_info = extract_bangumi_info(clean_url, html_content)
-                    except Exception as e:
-                        print(f"解析季度信息失败: {e}")
+                    else:
+                        print(f"获取季度信息失败: {season_data.get('message')}")
                         video_info = extract_bangumi_info(clean_url, html_content)
-                else:
-                    print("获取季度信息失败")
+                except Exception as e:
+                    print(f"解析季度信息失败: {e}")
                     video_info = extract_bangumi_info(clean_url, html_content)
-            elif ep_match:
-                ep_id = ep_match.group(1)
-                print(f"从URL中提取到epId: {ep_id}")
-                # 直接使用epId构建API请求
-                api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval=16&fourk=1"
-                print(f"使用epId构建API URL: {api_url}")
-                api_content = get_page_content(api_url)
-                if api_content:
-                    try:
-                        api_data = json.loads(api_content)
-                        if api_data.get('code') == 0 and 'result' in api_data:
-                            # 提取标题
-                            title_pattern = r'<title[^>]*>([^<]+)</title>'
-                            title_match = re.search(title_pattern, html_content)
-                            title = title_match.group(1).strip() if title_match else "bilibili_bangumi"
-                            title = title.replace(" - 哔哩哔哩番剧", "").replace(" - 哔哩哔哩", "")
-                            # 构造视频信息
-                            video_info = process_bangumi_api_response(api_data, title)
-                            if video_info:
-                                print("成功获取番剧视频信息")
-                            else:
-                                print("处理番剧API响应失败")
-                                video_info = extract_bangumi_info(clean_url, html_content)
-                        else:
-                            print(f"API返回错误: {api_data.get('message')}")
-                            video_info = extract_bangumi_info(clean_url, html_content)
-                    except Exception as e:
-                        print(f"解析API响应失败: {e}")
-                        video_info = extract_bangumi_info(clean_url, html_content)
-                else:
-                    print("获取API响应失败")
+            else:
+                print("获取季度信息失败")
+                video_info = extract_bangumi_info(clean_url, html_content)
+        elif ep_match:
+            ep_id = ep_match.group(1)
+            print(f"从URL中提取到epId: {ep_id}")
+            # 直接使用epId构建API请求
+            api_url = f"https://api.bilibili.com/pgc/player/web/playurl?ep_id={ep_id}&qn=127&fnval={PLAYURL_FNVAL}&fourk=1"
+            print(f"使用epId构建API URL: {api_url}")
+            api_content = get_page_content(api_url)
+            if api_content:
+                try:
+                    api_data = json.loads(api_content)
+                    if api_data.get('code') == 0 and 'result' in api_data:
+                        # 提取标题
+                        title_pattern = r'<title[^>]*>([^<]+)</title>'
+                        title_match = re.search(title_pattern, html_content)
+                        title = title_match.group(1).strip() if title_match else "bilibili_bangumi"
+                        title = title.replace(" - 哔哩哔哩番剧", "").replace(" - 哔哩哔哩", "")
+                        # 构造视频信息
+                        video_info = process_bangumi_api_response(api_data, title)
+                        if video_info:
+                            print("成功获取番剧视频信息")
+                        else:
+                            print("处理番剧API响应失败")
+                            video_info = extract_bangumi_info(clean_url, html_content)
+                    else:
+                        print(f"API返回错误: {api_data.get('message')}")
+                        video_info = extract_bangumi_info(clean_url, html_content)
+                except Exception as e:
+                    print(f"解析API响应失败: {e}")
                     video_info = extract_bangumi_info(clean_url, html_content)
             else:
-                print("URL中未找到ssId或epId")
+                print("获取API响应失败")
                 video_info = extract_bangumi_info(clean_url, html_content)
         else:
-            video_info = extract_video_info(html_content)
-            
+            print("URL中未找到ssId或epId")
+            video_info = extract_bangumi_info(clean_url, html_content)
+    else:
+        video_info = extract_video_info(html_content)
+    
+    return video_info
+
+
+def download_video(url, output_dir=None, retry_count=3, postprocessor=None, audio_only=False, size_budget=None):
+    """下载B站无水印视频
+    
+    Args:
+        url: B站视频链接
+        output_dir: 输出目录
+        retry_count: 下载失败时的重试次数
+        postprocessor: 后处理阶段(PostProcessor)，为None时在当前进程中直接合并
+        audio_only: 只下载最高质量的音轨
+        size_budget: 大小预算(字节)，选择不超过预算的最佳视频/音频组合
+    """
+    try:
+        # 创建输出目录（如果不存在）
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        else:
+            output_dir = os.getcwd()
+        
+        video_info = resolve_video_info(url)
         if not video_info:
             print("解析视频信息失败")
             sys.exit(1)
@@ -671,6 +1637,42 @@ def download_video(url, output_dir=None, retry_count=3):
         quality = video_info.get('quality', '未知')
         resolution = video_info.get('resolution', '未知')
         
+        if audio_only or size_budget:
+            streams = select_streams(video_info.get('play_data') or {}, audio_only, size_budget)
+            if streams:
+                video_url = streams['video_url']
+                audio_url = streams['audio_url']
+                quality = streams['quality']
+                resolution = streams['resolution']
+            if audio_only and (not streams or not audio_url):
+                # 不回退到下载完整视频
+                print("无法获取单独的音轨，仅音频模式下载失败")
+                sys.exit(1)
+        
+        headers = {
+            'User-Agent': get_user_agent(),
+            'Referer': url,
+            'Origin': 'https://www.bilibili.com',
+            'Accept': '*/*',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'Range': 'bytes=0-'
+        }
+        
+        if not video_url:
+            # 仅音频模式
+            print(f"音频标题: {title}")
+            audio_file = os.path.join(output_dir, f"{title}.m4a")
+            print(f"开始下载音频...")
+            if not download_file(audio_url, audio_file, headers):
+                print("音频下载失败")
+                sys.exit(1)
+            if postprocessor:
+                postprocessor.submit(audio_file)
+            print(f"音频已下载: {audio_file}")
+            print("下载完成！")
+            print(f"文件保存在: {output_dir}")
+            return
+        
         print(f"视频标题: {title}")
         print(f"视频清晰度: {quality} {resolution}")
         print("正在下载最高清晰度视频...")
@@ -682,15 +1684,6 @@ def download_video(url, output_dir=None, retry_count=3):
         
         # 下载视频
         print(f"开始下载视频...")
-        headers = {
-            'User-Agent': get_user_agent(),
-            'Referer': url,
-            'Origin': 'https://www.bilibili.com',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Range': 'bytes=0-'
-        }
-        
         if not download_file(video_url, video_file, headers):
             print("视频下载失败")
             sys.exit(1)
@@ -705,7 +1698,11 @@ def download_video(url, output_dir=None, retry_count=3):
                 
             # 尝试合并视频和音频
             output_file = os.path.join(output_dir, f"{title}.mp4")
-            if merge_video_audio(video_file, audio_file, output_file):
+            if postprocessor:
+                # 交给后处理阶段，下载线程可以立即开始下一个任务
+                postprocessor.submit(video_file, audio_file, output_file)
+                print(f"已提交后处理: {title}")
+            elif merge_video_audio(video_file, audio_file, output_file):
                 print(f"视频和音频已合并: {output_file}")
                 # 删除临时文件
                 os.remove(video_file)
@@ -714,6 +1711,8 @@ def download_video(url, output_dir=None, retry_count=3):
                 print(f"视频文件: {video_file}")
                 print(f"音频文件: {audio_file}")
         else:
+            if postprocessor:
+                postprocessor.submit(video_file)
             print(f"视频已下载: {video_file}")
             
         print("下载完成！")
@@ -822,7 +1821,8 @@ def process_bangumi_api_response(api_data, title):
             'video_url': video_url,
             'audio_url': audio_url,
             'quality': video_quality,
-            'resolution': video_resolution
+            'resolution': video_resolution,
+            'play_data': result
         }
     except Exception as e:
         print(f"处理番剧API响应失败: {e}")
@@ -861,22 +1861,999 @@ def process_bangumi_api_response(api_data, title):
         sys.exit(1)
 
 
+# 增量同步的默认检查点文件（保存在输出目录中）
+SYNC_STATE_FILE = '.bili_sync_state.json'
+# 每个同步源在检查点中保留的最近已下载BV号数量
+SYNC_SEEN_LIMIT = 50
+# 同步中单个视频的最大尝试次数，超过后跳过该视频
+SYNC_MAX_ATTEMPTS = 3
+
+# WBI签名使用的混淆表
+MIXIN_KEY_ENC_TAB = [
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+    33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40,
+    61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11,
+    36, 20, 34, 44, 52
+]
+
+
+def parse_sync_source(url):
+    """解析UP主空间或收藏夹链接
+
+    Returns:
+        ('space', mid) 或 ('fav', media_id)，无法识别时返回None
+    """
+    match = re.match(r'https?://space\.bilibili\.com/\d+/favlist\?(?:.*&)?fid=(\d+)', url)
+    if match:
+        return ('fav', match.group(1))
+    match = re.match(r'https?://(?:www\.)?bilibili\.com/medialist/detail/ml(\d+)', url)
+    if match:
+        return ('fav', match.group(1))
+    match = re.match(r'https?://space\.bilibili\.com/(\d+)', url)
+    if match:
+        return ('space', match.group(1))
+    return None
+
+
+def get_wbi_mixin_key():
+    """从导航接口获取WBI签名所需的mixin key"""
+    content = get_page_content("https://api.bilibili.com/x/web-interface/nav")
+    if not content:
+        print("获取WBI签名密钥失败")
+        return None
+    try:
+        # 未登录时code为-101，但data中仍然包含wbi_img
+        wbi_img = json.loads(content)['data']['wbi_img']
+        img_key = wbi_img['img_url'].rsplit('/', 1)[-1].split('.')[0]
+        sub_key = wbi_img['sub_url'].rsplit('/', 1)[-1].split('.')[0]
+        orig = img_key + sub_key
+        return ''.join(orig[i] for i in MIXIN_KEY_ENC_TAB)[:32]
+    except Exception as e:
+        print(f"解析WBI签名密钥失败: {e}")
+        return None
+
+
+def sign_wbi_params(params, mixin_key):
+    """为API参数添加WBI签名(wts和w_rid)"""
+    params = dict(params)
+    params['wts'] = int(time.time())
+    params = {
+        key: ''.join(c for c in str(value) if c not in "!'()*")
+        for key, value in sorted(params.items())
+    }
+    query = urllib.parse.urlencode(params)
+    params['w_rid'] = hashlib.md5((query + mixin_key).encode('utf-8')).hexdigest()
+    return params
+
+
+def fetch_sync_page(kind, source_id, page, mixin_key=None):
+    """获取UP主投稿或收藏夹的一页视频列表（从新到旧）
+
+    Returns:
+        (items, has_more)，items为[{'bvid', 'time', 'title'}]；失败时返回None
+    """
+    if kind == 'space':
+        params = sign_wbi_params({'mid': source_id, 'ps': 30, 'pn': page, 'order': 'pubdate'}, mixin_key)
+        api_url = "https://api.bilibili.com/x/space/wbi/arc/search?" + urllib.parse.urlencode(params)
+    else:
+        params = {'media_id': source_id, 'ps': 20, 'pn': page, 'order': 'mtime', 'platform': 'web'}
+        api_url = "https://api.bilibili.com/x/v3/fav/resource/list?" + urllib.parse.urlencode(params)
+    
+    content = get_page_content(api_url)
+    if not content:
+        print(f"获取第{page}页列表失败")
+        return None
+    
+    try:
+        api_data = json.loads(content)
+        if api_data.get('code') != 0:
+            print(f"API返回错误: {api_data.get('message')}")
+            return None
+        
+        data = api_data.get('data') or {}
+        items = []
+        if kind == 'space':
+            vlist = (data.get('list') or {}).get('vlist') or []
+            for video in vlist:
+                items.append({'bvid': video.get('bvid'), 'time': video.get('created', 0), 'title': video.get('title', '')})
+            page_info = data.get('page') or {}
+            has_more = page * page_info.get('ps', 30) < page_info.get('count', 0)
+        else:
+            for media in data.get('medias') or []:
+                # 只同步视频稿件(type=2)，跳过音频和合集
+                if media.get('type') != 2:
+                    continue
+                items.append({
+                    'bvid': media.get('bvid') or media.get('bv_id'),
+                    'time': media.get('fav_time', 0),
+                    'title': media.get('title', ''),
+                    # attr最低位为1表示视频已失效
+                    'invalid': bool(media.get('attr', 0) & 1)
+                })
+            has_more = bool(data.get('has_more'))
+        return items, has_more
+    except Exception as e:
+        print(f"解析列表失败: {e}")
+        return None
+
+
+def collect_new_items(kind, source_id, checkpoint):
+    """从最新一页开始翻页，遇到上次同步的检查点即停止
+
+    Returns:
+        新视频列表（从新到旧），获取列表失败时返回None
+    """
+    last_time = checkpoint.get('last_time', 0)
+    seen = set(checkpoint.get('seen', []))
+    
+    mixin_key = None
+    if kind == 'space':
+        mixin_key = get_wbi_mixin_key()
+        if not mixin_key:
+            return None
+    
+    new_items = []
+    page = 1
+    while True:
+        result = fetch_sync_page(kind, source_id, page, mixin_key)
+        if result is None:
+            return None
+        items, has_more = result
+        for item in items:
+            if item['bvid'] in seen or item['time'] < last_time:
+                return new_items
+            if item.get('invalid'):
+                print(f"跳过失效视频: {item['bvid']}")
+                continue
+            new_items.append(item)
+        if not has_more or not items:
+            return new_items
+        page += 1
+
+
+def load_sync_state(state_file):
+    """读取同步检查点文件"""
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"读取检查点文件失败: {e}")
+        return {}
+
+
+def save_sync_state(state_file, state):
+    """写入同步检查点文件（先写临时文件再替换，避免中断时损坏）"""
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, state_file)
+
+
+def run_download(url, output_dir=None, retry_count=3, postprocessor=None, audio_only=False, size_budget=None):
+    """下载单个视频，失败时返回False而不是退出进程"""
+    try:
+        download_video(url, output_dir, retry_count, postprocessor, audio_only, size_budget)
+        return True
+    except SystemExit:
+        return False
+
+
+def get_video_key(url):
+    """返回URL对应视频的唯一标识，用于去重"""
+    clean_url = url.split('?')[0].split('#')[0].rstrip('/')
+    match = re.search(r'/video/([Bb][Vv][0-9A-Za-z]+)', clean_url)
+    if match:
+        # BV号除前缀外区分大小写
+        return 'BV' + match.group(1)[2:]
+    match = re.search(r'/video/[Aa][Vv](\d+)', clean_url)
+    if match:
+        return 'av' + match.group(1)
+    match = re.search(r'/bangumi/play/(ss|ep)(\d+)', clean_url)
+    if match:
+        return match.group(1) + match.group(2)
+    return clean_url
+
+
+def dedupe_urls(urls):
+    """去除指向同一视频的重复URL，保留首次出现的顺序"""
+    seen = set()
+    result = []
+    for url in urls:
+        key = get_video_key(url)
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(url)
+    return result
+
+
+def read_url_list(filename):
+    """从文件读取URL列表，每行一个，忽略空行和#开头的注释"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def download_batch(urls, output_dir=None, retry_count=3, jobs=1, postprocessor=None, audio_only=False, size_budget=None):
+    """使用多个下载线程批量下载视频
+
+    Returns:
+        下载失败的URL列表
+    """
+    unique_urls = dedupe_urls(urls)
+    if len(unique_urls) < len(urls):
+        print(f"已去除 {len(urls) - len(unique_urls)} 个重复链接")
+    urls = unique_urls
+    
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(run_download, url, output_dir, retry_count, postprocessor, audio_only, size_budget): url for url in urls}
+        for future, url in futures.items():
+            if not future.result():
+                failed.append(url)
+    return failed
+
+
+def sync_source(url, output_dir=None, retry_count=3, state_file=None, postprocessor=None,
+                audio_only=False, size_budget=None):
+    """增量同步UP主空间或收藏夹中的视频
+
+    只下载上次检查点之后新增的视频。视频按从旧到新的顺序下载，每处理一个就推进
+    一次检查点。下载或后处理失败的视频记录在检查点的failed中，不会阻塞后面的视频，
+    之后每次同步时优先重试，失败SYNC_MAX_ATTEMPTS次后跳过并记录到skipped。
+    返回前会等待本次同步提交的后处理全部结束。
+    
+    Args:
+        url: UP主空间或收藏夹链接
+        output_dir: 输出目录
+        retry_count: 下载失败时的重试次数
+        state_file: 检查点文件路径，默认为输出目录下的.bili_sync_state.json
+        postprocessor: 后处理阶段(PostProcessor)
+        audio_only: 只下载音轨
+        size_budget: 每个视频的大小预算(字节)
+
+    Returns:
+        列表获取成功且本次没有视频下载失败时返回True
+    """
+    source = parse_sync_source(url)
+    if not source:
+        print("错误: 请提供有效的UP主空间或收藏夹链接")
+        return False
+    kind, source_id = source
+    
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if not state_file:
+        state_file = os.path.join(output_dir or os.getcwd(), SYNC_STATE_FILE)
+    
+    state = load_sync_state(state_file)
+    source_key = f"{kind}:{source_id}"
+    checkpoint = state.get(source_key, {})
+    if checkpoint:
+        print(f"上次同步时间: {checkpoint.get('updated_at', '未知')}")
+    else:
+        print("首次同步，将获取完整列表")
+    
+    new_items = collect_new_items(kind, source_id, checkpoint)
+    if new_items is None:
+        print("获取视频列表失败，本次不做同步")
+        return False
+    
+    # 先重试之前失败的视频，再从旧到新下载新视频
+    failed = checkpoint.setdefault('failed', {})
+    items = [
+        {'bvid': bvid, 'time': info.get('time', 0), 'title': info.get('title', ''), 'retry': True}
+        for bvid, info in failed.items()
+    ]
+    items += list(reversed(new_items))
+    if not items:
+        print("没有新视频")
+        return True
+    
+    if new_items:
+        print(f"发现 {len(new_items)} 个新视频")
+    if failed:
+        print(f"重试 {len(failed)} 个之前下载失败的视频")
+    
+    ok = True
+    # 已下载完成、正在后处理的视频，后处理结束后才算同步成功
+    postprocessing = {}
+    postprocess_results = queue.Queue()
+    
+    def record_failure(item):
+        bvid = item['bvid']
+        attempts = failed.get(bvid, {}).get('attempts', 0) + 1
+        if attempts >= SYNC_MAX_ATTEMPTS:
+            failed.pop(bvid, None)
+            checkpoint['skipped'] = ([bvid] + checkpoint.get('skipped', []))[:SYNC_SEEN_LIMIT]
+            print(f"下载 {bvid} 已失败 {attempts} 次，跳过该视频")
+        else:
+            failed[bvid] = {'attempts': attempts, 'time': item['time'], 'title': item['title']}
+            print(f"下载 {bvid} 失败（第{attempts}次），下次同步时重试")
+    
+    def collect_postprocess_results(block):
+        nonlocal ok
+        while postprocessing:
+            try:
+                bvid, success = postprocess_results.get(block=block)
+            except queue.Empty:
+                return
+            item = postprocessing.pop(bvid)
+            if success:
+                failed.pop(bvid, None)
+            else:
+                ok = False
+                record_failure(item)
+    
+    def save():
+        checkpoint['updated_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        state[source_key] = checkpoint
+        save_sync_state(state_file, state)
+    
+    for index, item in enumerate(items, 1):
+        bvid = item['bvid']
+        print(f"[{index}/{len(items)}] {bvid} {item['title']}")
+        video_url = f"https://www.bilibili.com/video/{bvid}"
+        
+        # 先记入failed，进程中断时下次同步会重试；成功后再移除
+        failed.setdefault(bvid, {'attempts': 0, 'time': item['time'], 'title': item['title']})
+        bound = None
+        if postprocessor:
+            bound = postprocessor.bind(lambda success, bvid=bvid: postprocess_results.put((bvid, success)))
+        if run_download(video_url, output_dir, retry_count, bound, audio_only, size_budget):
+            if postprocessor:
+                postprocessing[bvid] = item
+            else:
+                failed.pop(bvid, None)
+        else:
+            ok = False
+            record_failure(item)
+        
+        # 失败的视频已记录在failed中，检查点照常推进
+        if not item.get('retry'):
+            checkpoint['last_time'] = max(checkpoint.get('last_time', 0), item['time'])
+            checkpoint['seen'] = ([bvid] + checkpoint.get('seen', []))[:SYNC_SEEN_LIMIT]
+        collect_postprocess_results(block=False)
+        save()
+    
+    # 等待本次同步的后处理全部结束
+    collect_postprocess_results(block=True)
+    save()
+    
+    if ok:
+        print("同步完成！")
+    else:
+        print(f"同步完成，部分视频下载失败（{len(failed)} 个等待下次重试）")
+    return ok
+
+
+# 清晰度代码与名称的对应关系
+QUALITY_NAMES = {
+    16: "240P",
+    32: "360P",
+    64: "480P",
+    74: "720P",
+    80: "1080P",
+    112: "1080P+",
+    116: "1080P60",
+    120: "4K",
+    125: "HDR",
+    126: "杜比视界",
+    127: "8K",
+    128: "4K HDR",
+    129: "8K HDR",
+    30: "360P 流畅",
+    48: "720P 高清",
+    66: "720P60",
+    70: "1080P60 高帧率"
+}
+
+
+def get_stream_mirrors(stream):
+    """返回DASH流或durl分段的备用地址列表"""
+    return stream.get('backupUrl') or stream.get('backup_url') or []
+
+
+def get_play_duration(play_data):
+    """返回视频时长(秒)，无法获取时返回0"""
+    dash = play_data.get('dash') or {}
+    if dash.get('duration'):
+        return dash['duration']
+    if play_data.get('timelength'):
+        return play_data['timelength'] / 1000
+    return 0
+
+
+def parse_size(text):
+    """解析大小字符串，如 500M、1.5G、800000，返回字节数"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"无效的大小: {text}")
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+
+def get_audio_streams(dash):
+    """返回所有音轨，按质量从高到低排序（Hi-Res无损 > 杜比全景声 > 普通音轨，同类按带宽）"""
+    audios = [(0, audio) for audio in dash.get('audio') or []]
+    audios += [(1, audio) for audio in (dash.get('dolby') or {}).get('audio') or []]
+    flac_audio = (dash.get('flac') or {}).get('audio')
+    if flac_audio:
+        audios.append((2, flac_audio))
+    audios.sort(key=lambda x: (x[0], x[1].get('bandwidth', 0)), reverse=True)
+    return [audio for _, audio in audios]
+
+
+def select_streams(play_data, audio_only=False, size_budget=None):
+    """按仅音频或大小预算模式选择要下载的流
+
+    大小按 带宽 × 时长 估算。没有组合能满足预算时选择最小的组合。
+
+    Returns:
+        包含video_url、audio_url、quality、resolution的字典（仅音频时video_url为None），
+        播放信息不是DASH格式时返回None
+    """
+    dash = play_data.get('dash')
+    if not dash:
+        print("视频不是DASH格式，无法按音频或大小选择")
+        return None
+    
+    duration = get_play_duration(play_data)
+    if size_budget and not duration:
+        print("警告: 无法获取视频时长，无法估算大小，大小预算不生效")
+    audios = get_audio_streams(dash)
+    videos = [] if audio_only else sorted(dash.get('video') or [], key=lambda x: (x.get('id', 0), x.get('bandwidth', 0)), reverse=True)
+    if audio_only and not audios:
+        print("没有可用的音轨")
+        return None
+    
+    def estimate(video, audio):
+        bandwidth = (video or {}).get('bandwidth', 0) + (audio or {}).get('bandwidth', 0)
+        return bandwidth * duration / 8
+    
+    # 候选组合已按质量从高到低排列
+    candidates = [(video, audio) for video in videos or [None] for audio in audios or [None]]
+    selected = candidates[0]
+    if size_budget:
+        fitting = [pair for pair in candidates if estimate(*pair) <= size_budget]
+        if fitting:
+            selected = fitting[0]
+        else:
+            selected = min(candidates, key=lambda pair: estimate(*pair))
+            print(f"没有组合能满足 {size_budget/1024/1024:.0f} MB 的预算，选择最小的组合")
+    
+    video, audio = selected
+    quality = "仅音频"
+    resolution = ""
+    if video:
+        quality = QUALITY_NAMES.get(video.get('id'), f"未知({video.get('id')})")
+        if 'width' in video and 'height' in video:
+            resolution = f"{video['width']}x{video['height']}"
+    if audio:
+        print(f"已选择音频: {audio.get('bandwidth', 0)/1000:.0f}Kbps (id={audio.get('id')})")
+    if duration:
+        print(f"预计下载大小: {estimate(video, audio)/1024/1024:.2f} MB")
+    
+    return {
+        'video_url': (video.get('baseUrl') or video.get('base_url')) if video else None,
+        'audio_url': (audio.get('baseUrl') or audio.get('base_url')) if audio else None,
+        'quality': quality,
+        'resolution': resolution
+    }
+
+
+def build_manifest_record(url, video_info):
+    """根据解析结果构建清单记录，列出所有可用的视频/音频流
+
+    DASH流没有提供文件大小，按 带宽 × 时长 估算。
+    """
+    play_data = video_info.get('play_data') or {}
+    duration = get_play_duration(play_data)
+    record = {
+        'url': url,
+        'key': get_video_key(url),
+        'ok': True,
+        'title': video_info['title'],
+        'duration': duration,
+        'selected': {
+            'quality': video_info.get('quality'),
+            'resolution': video_info.get('resolution'),
+            'video_url': video_info['video_url'],
+            'audio_url': video_info['audio_url']
+        },
+        'video': [],
+        'audio': [],
+        'durl': []
+    }
+    
+    dash = play_data.get('dash') or {}
+    for video in dash.get('video') or []:
+        bandwidth = video.get('bandwidth', 0)
+        record['video'].append({
+            'id': video.get('id'),
+            'quality': QUALITY_NAMES.get(video.get('id'), f"未知({video.get('id')})"),
+            'codecs': video.get('codecs'),
+            'codecid': video.get('codecid'),
+            'bandwidth': bandwidth,
+            'width': video.get('width'),
+            'height': video.get('height'),
+            'frame_rate': video.get('frameRate') or video.get('frame_rate'),
+            'size': int(bandwidth * duration / 8),
+            'size_estimated': True,
+            'url': video.get('baseUrl') or video.get('base_url'),
+            'mirrors': get_stream_mirrors(video)
+        })
+    
+    # 普通音轨、杜比全景声和Hi-Res无损音轨
+    audio_groups = [('normal', dash.get('audio') or [])]
+    audio_groups.append(('dolby', (dash.get('dolby') or {}).get('audio') or []))
+    flac_audio = (dash.get('flac') or {}).get('audio')
+    audio_groups.append(('flac', [flac_audio] if flac_audio else []))
+    for audio_type, audios in audio_groups:
+        for audio in audios:
+            bandwidth = audio.get('bandwidth', 0)
+            record['audio'].append({
+                'id': audio.get('id'),
+                'type': audio_type,
+                'codecs': audio.get('codecs'),
+                'bandwidth': bandwidth,
+                'size': int(bandwidth * duration / 8),
+                'size_estimated': True,
+                'url': audio.get('baseUrl') or audio.get('base_url'),
+                'mirrors': get_stream_mirrors(audio)
+            })
+    
+    for segment in play_data.get('durl') or []:
+        record['durl'].append({
+            'order': segment.get('order'),
+            'size': segment.get('size'),
+            'length': segment.get('length'),
+            'url': segment.get('url'),
+            'mirrors': get_stream_mirrors(segment)
+        })
+    
+    return record
+
+
+def resolve_manifest_record(url):
+    """解析单个链接并返回清单记录，不下载任何媒体数据"""
+    try:
+        video_info = resolve_video_info(url)
+    except Exception as e:
+        return {'url': url, 'key': get_video_key(url), 'ok': False, 'error': str(e)}
+    if not video_info:
+        return {'url': url, 'key': get_video_key(url), 'ok': False, 'error': '解析视频信息失败'}
+    return build_manifest_record(url, video_info)
+
+
+def export_manifest(urls, manifest_file, jobs=1):
+    """并发解析链接，把每个视频的所有可用流以JSONL格式逐行写入清单文件
+
+    Returns:
+        解析失败的数量
+    """
+    urls = dedupe_urls(urls)
+    failed = 0
+    done = 0
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [executor.submit(resolve_manifest_record, url) for url in urls]
+            for future in as_completed(futures):
+                record = future.result()
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                done += 1
+                if not record['ok']:
+                    failed += 1
+                print(f"[清单] 已解析 {done}/{len(urls)}: {record['url']}")
+    
+    print(f"清单已写入: {manifest_file}（成功 {done - failed}，失败 {failed}）")
+    return failed
+
+
+class JobQueue:
+    """基于SQLite文件的共享任务队列，多个进程或多台机器可以同时领取任务
+
+    任务以租约方式领取：领取后在lease_seconds内有效，工作进程需要定期续约，
+    进程崩溃导致租约过期后任务会被其他工作进程重新领取。只有持有租约的工作进程
+    才能把任务标记为完成，因此每个任务只会被记录完成一次。
+    """
+    
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        conn = self._connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL,
+                    completed_at REAL
+                )
+            ''')
+        finally:
+            conn.close()
+    
+    def _connect(self):
+        # isolation_level=None表示自动提交，需要事务时显式BEGIN
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+    
+    def enqueue(self, urls):
+        """添加任务，同一视频只会入队一次
+
+        Returns:
+            新添加的任务数
+        """
+        added = 0
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for url in urls:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO jobs (key, url, created_at) VALUES (?, ?, ?)',
+                    (get_video_key(url), url, time.time()))
+                added += cursor.rowcount
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return added
+    
+    def lease(self, worker_id):
+        """领取一个待处理或租约已过期的任务
+
+        Returns:
+            (key, url)，没有可领取的任务时返回None
+        """
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE获取写锁，保证同一任务不会被两个进程同时领取
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            while True:
+                row = conn.execute(
+                    "SELECT key, url, state, owner, attempts FROM jobs "
+                    "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                    "ORDER BY rowid LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                key, url, state, owner, attempts = row
+                if state != 'leased' or attempts < self.max_attempts:
+                    break
+                # 多次在处理中导致工作进程崩溃或卡死的任务不再回收
+                conn.execute(
+                    "UPDATE jobs SET state = 'failed', owner = NULL, lease_expires = NULL, error = ? WHERE key = ?",
+                    (f'租约过期{attempts}次', key))
+                print(f"任务 {key} 的租约已过期 {attempts} 次，标记为失败（原工作进程 {owner}）")
+            conn.execute(
+                "UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE key = ?", (worker_id, now + self.lease_seconds, key))
+            conn.execute('COMMIT')
+            if state == 'leased':
+                print(f"回收过期租约: {key}（原工作进程 {owner}）")
+            return key, url
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    def _update_owned(self, sql, params):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).rowcount == 1
+        finally:
+            conn.close()
+    
+    def heartbeat(self, key, worker_id):
+        """续约，返回False表示租约已经丢失"""
+        return self._update_owned(
+            "UPDATE jobs SET lease_expires = ? WHERE key = ? AND owner = ? AND state = 'leased'",
+            (time.time() + self.lease_seconds, key, worker_id))
+    
+    def complete(self, key, worker_id):
+        """标记任务完成，返回False表示租约已被其他工作进程接管"""
+        return self._update_owned(
+            "UPDATE jobs SET state = 'done', completed_at = ?, error = NULL "
+            "WHERE key = ? AND owner = ? AND state = 'leased'",
+            (time.time(), key, worker_id))
+    
+    def fail(self, key, worker_id, error):
+        """标记任务失败，未达到最大尝试次数时重新放回队列"""
+        return self._update_owned(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "owner = NULL, lease_expires = NULL, error = ? "
+            "WHERE key = ? AND owner = ? AND state = 'leased'",
+            (self.max_attempts, error, key, worker_id))
+    
+    def counts(self):
+        """返回各状态的任务数"""
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        finally:
+            conn.close()
+
+
+class LeaseHeartbeat:
+    """后台线程定期为正在处理的任务续约"""
+    
+    def __init__(self, job_queue, key, worker_id):
+        self.job_queue = job_queue
+        self.key = key
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+    
+    def _run(self):
+        interval = max(1.0, self.job_queue.lease_seconds / 3)
+        while not self._stop.wait(interval):
+            try:
+                if not self.job_queue.heartbeat(self.key, self.worker_id):
+                    self.lost = True
+                    print(f"任务 {self.key} 的租约已丢失")
+                    return
+            except sqlite3.Error as e:
+                print(f"续约失败: {e}")
+
+
+def run_worker_loop(job_queue, worker_id, output_dir=None, retry_count=3, postprocessor=None,
+                    audio_only=False, size_budget=None, poll_interval=5):
+    """以worker_id身份循环领取并下载任务，队列中没有未完成的任务时退出
+
+    有后处理阶段时，任务在后处理结束后才标记完成或失败，期间一直续约。
+
+    Returns:
+        完成的任务数
+    """
+    completed = [0]
+    lock = threading.Lock()
+    
+    def finish(key, heartbeat, success):
+        heartbeat.stop()
+        if not success:
+            job_queue.fail(key, worker_id, '下载或后处理失败')
+        elif job_queue.complete(key, worker_id):
+            with lock:
+                completed[0] += 1
+        else:
+            print(f"任务 {key} 已被其他工作进程接管，不重复记录完成")
+    
+    while True:
+        job = job_queue.lease(worker_id)
+        if job is None:
+            counts = job_queue.counts()
+            if not counts.get('pending') and not counts.get('leased'):
+                break
+            # 其他工作进程还在处理，等待它们完成或租约过期
+            time.sleep(poll_interval)
+            continue
+        
+        key, url = job
+        print(f"[{worker_id}] 领取任务: {url}")
+        heartbeat = LeaseHeartbeat(job_queue, key, worker_id).start()
+        bound = None
+        if postprocessor:
+            bound = postprocessor.bind(lambda success, key=key, heartbeat=heartbeat: finish(key, heartbeat, success))
+        if not run_download(url, output_dir, retry_count, bound, audio_only, size_budget):
+            finish(key, heartbeat, False)
+        elif not postprocessor:
+            finish(key, heartbeat, True)
+    return completed[0]
+
+
+def run_worker(queue_path, output_dir=None, retry_count=3, postprocessor=None,
+               audio_only=False, size_budget=None, lease_seconds=300, jobs=1):
+    """从共享任务队列中领取并下载视频，jobs个下载线程各自持有租约
+
+    Returns:
+        本工作进程完成的任务数
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    job_queue = JobQueue(queue_path, lease_seconds)
+    print(f"工作进程 {worker_id} 已启动（{jobs} 个下载线程）")
+    
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            executor.submit(run_worker_loop, job_queue, f"{worker_id}-{index}", output_dir, retry_count,
+                            postprocessor, audio_only, size_budget)
+            for index in range(max(1, jobs))
+        ]
+        completed = sum(future.result() for future in futures)
+    
+    print(f"工作进程 {worker_id} 结束，完成 {completed} 个任务，队列状态: {job_queue.counts()}")
+    return completed
+
+
+def worker_process_main(queue_path, options):
+    """队列模式下每个工作进程的入口
+
+    Returns:
+        后处理全部成功时返回True
+    """
+    WRITER_OPTIONS.update(options['writer'])
+    postprocessor = PostProcessor(options['post_workers'], checksum=options['checksum'])
+    ok = False
+    try:
+        run_worker(queue_path, options['output_dir'], options['retry'], postprocessor,
+                   options['audio_only'], options['size_budget'], options['lease_seconds'], options['jobs'])
+    finally:
+        ok = postprocessor.close()
+        if options['stats']:
+            HOST_CONTROLLER.print_stats()
+    return ok
+
+
+def worker_process_entry(queue_path, options):
+    """本机多工作进程模式下子进程的入口，失败时以非零状态退出"""
+    if not worker_process_main(queue_path, options):
+        sys.exit(1)
+
+
 def main():
     parser = argparse.ArgumentParser(description='B站无水印视频下载器')
-    parser.add_argument('url', help='B站视频链接')
+    parser.add_argument('urls', nargs='*', metavar='url', help='B站视频链接（可以传入多个）')
+    parser.add_argument('-i', '--input-file', help='从文件读取视频链接，每行一个')
     parser.add_argument('-o', '--output-dir', help='视频保存目录')
     parser.add_argument('-r', '--retry', type=int, default=3, help='下载失败时的重试次数')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='同时下载的视频数量（队列模式下为每个工作进程的下载线程数）')
+    parser.add_argument('--post-workers', type=int, help='后处理（合并、校验）进程数，默认为CPU核数（队列模式下由本机工作进程平分）')
+    parser.add_argument('--checksum', action='store_true', help='为下载的文件生成.sha256校验文件')
+    parser.add_argument('-a', '--audio-only', action='store_true', help='只下载最高质量的音轨（包括杜比全景声/Hi-Res无损）')
+    parser.add_argument('--max-size', help='每个视频的大小预算，如500M、2G，选择不超过预算的最佳视频/音频组合')
+    parser.add_argument('--manifest', metavar='FILE', help='只解析链接，把所有可用的视频/音频流写入JSONL清单文件，不下载媒体数据')
+    parser.add_argument('-s', '--sync', action='store_true', help='增量同步UP主空间或收藏夹，只下载新视频')
+    parser.add_argument('--state-file', help='同步检查点文件（默认保存在输出目录中）')
+    parser.add_argument('-q', '--queue', metavar='DB', help='共享任务队列(SQLite文件)，传入的链接会加入队列，然后从队列领取任务下载')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='队列模式下在本机启动的工作进程数（0表示只入队不下载）')
+    parser.add_argument('--lease', type=int, default=300, help='队列模式下任务租约的有效期(秒)')
+    parser.add_argument('--staging-dir', help='下载中文件的临时目录（默认为输出目录下的.staging），完成后移动到输出目录')
+    parser.add_argument('--fsync', choices=['never', 'close', 'always'], default='close',
+                        help='写盘同步策略: never=不同步, close=文件写完后同步(默认), always=每块写入后同步')
+    parser.add_argument('--write-buffer', type=int, default=16, help='每个文件的写入缓冲区大小(MB)，写满时暂停网络读取')
+    parser.add_argument('--stats', action='store_true', help='结束时打印各主机的并发、速度和状态码统计')
     parser.add_argument('-v', '--version', action='version', version='B站无水印视频下载器 v1.1.0')
     
     args = parser.parse_args()
     
+    if args.input_file:
+        try:
+            args.urls += read_url_list(args.input_file)
+        except OSError as e:
+            print(f"读取链接文件失败: {e}")
+            sys.exit(1)
+    if not args.urls and not args.queue:
+        parser.error('请提供视频链接或使用--input-file指定链接文件')
+    
+    size_budget = None
+    if args.max_size:
+        try:
+            size_budget = parse_size(args.max_size)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    WRITER_OPTIONS['staging_dir'] = args.staging_dir
+    WRITER_OPTIONS['fsync'] = args.fsync
+    WRITER_OPTIONS['queue_size'] = max(1, args.write_buffer)
+    
     # 检查URL是否有效
-    if not is_valid_bilibili_url(args.url):
-        print("错误: 请提供有效的B站视频链接")
-        sys.exit(1)
+    if not args.sync:
+        for url in args.urls:
+            if not is_valid_bilibili_url(url):
+                print(f"错误: 请提供有效的B站视频链接: {url}")
+                sys.exit(1)
+    
+    # 清单导出模式
+    if args.manifest:
+        try:
+            failed = export_manifest(args.urls, args.manifest, args.jobs)
+        except OSError as e:
+            print(f"写入清单文件失败: {e}")
+            sys.exit(1)
+        if args.stats:
+            HOST_CONTROLLER.print_stats()
+        if failed:
+            sys.exit(1)
+        return
+    
+    # 共享任务队列模式
+    if args.queue:
+        job_queue = JobQueue(args.queue, args.lease)
+        if args.urls:
+            added = job_queue.enqueue(dedupe_urls(args.urls))
+            print(f"已加入队列 {added} 个任务，队列状态: {job_queue.counts()}")
+        # 本机所有工作进程共享CPU，后处理进程数按工作进程数平分
+        local_workers = max(1, args.workers)
+        post_workers = max(1, (args.post_workers or os.cpu_count() or 1) // local_workers)
+        options = {
+            'output_dir': args.output_dir,
+            'retry': args.retry,
+            'jobs': args.jobs,
+            'post_workers': post_workers,
+            'checksum': args.checksum,
+            'audio_only': args.audio_only,
+            'size_budget': size_budget,
+            'lease_seconds': args.lease,
+            'stats': args.stats,
+            'writer': dict(WRITER_OPTIONS)
+        }
+        workers_ok = True
+        if args.workers == 1:
+            workers_ok = worker_process_main(args.queue, options)
+        elif args.workers > 1:
+            context = multiprocessing.get_context('spawn')
+            processes = [context.Process(target=worker_process_entry, args=(args.queue, options))
+                         for _ in range(args.workers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+                if process.exitcode != 0:
+                    print(f"工作进程 {process.pid} 异常退出，退出码: {process.exitcode}")
+                    workers_ok = False
+        counts = job_queue.counts()
+        print(f"队列状态: {counts}")
+        if args.workers > 0 and (counts.get('pending') or counts.get('leased')):
+            # 工作进程全部崩溃时任务会停留在未完成状态
+            print("队列中仍有未完成的任务")
+            workers_ok = False
+        if counts.get('failed') or not workers_ok:
+            sys.exit(1)
+        return
     
-    # 下载视频
-    download_video(args.url, args.output_dir, args.retry)
+    postprocessor = PostProcessor(args.post_workers, checksum=args.checksum)
+    ok = True
+    try:
+        if args.sync:
+            # 增量同步模式
+            for url in args.urls:
+                if not sync_source(url, args.output_dir, args.retry, args.state_file, postprocessor,
+                                   args.audio_only, size_budget):
+                    ok = False
+        else:
+            # 下载视频
+            failed = download_batch(args.urls, args.output_dir, args.retry, args.jobs, postprocessor,
+                                    args.audio_only, size_budget)
+            if failed:
+                ok = False
+                print(f"{len(failed)} 个视频下载失败:")
+                for url in failed:
+                    print(f"  {url}")
+    finally:
+        if not postprocessor.close():
+            ok = False
+        if args.stats:
+            HOST_CONTROLLER.print_stats()
+    
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -884,4 +2861,4 @@ if __name__ == '__main__':
         print("使用方法: python bilibili_downloader.py [视频URL] [-o 输出目录]")
         sys.exit(1)
     
-    main()
\ No newline at end of file
+    main()